@@ -5,20 +5,32 @@ Sushi Chef for MEET Community Health Training for Migrants, from
 http://migranthealth.eu/etraining/course/index.php?categoryid=1
 """
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import os
+import pickle
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import shutil
 import tempfile
 import time
-from urllib.parse import urlparse, parse_qs
-import uuid
+from urllib.parse import urljoin, parse_qs
 
 from bs4 import BeautifulSoup
+from cachecontrol.heuristics import ExpiresAfter
+from cssselect import HTMLTranslator
+import lxml.etree
+import lxml.html
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
 
 from le_utils.constants import languages
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, licenses
-from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter, InvalidatingCacheControlAdapter
+from ricecooker.utils.caching import FileCache, CacheControlAdapter, InvalidatingCacheControlAdapter
 from ricecooker.utils.browser import preview_in_browser
 from ricecooker.utils.html import download_file, WebDriver
 from ricecooker.utils.zip import create_predictable_zip
@@ -32,12 +44,13 @@ except ImportError:
         "See secrets.py.example for a template.")
 
 
-sess = requests.Session()
-cache = FileCache('.webcache')
-forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
-
-sess.mount('http://migranthealth.eu', forever_adapter)
-
+# Sibling pages (languages, modules, units, articles) are fetched concurrently,
+# but never more than this many pages (plus as many static assets) at once.
+MAX_CONCURRENT_REQUESTS = 16
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+# Static assets of an article page are fetched from within `executor`, so they
+# get a pool of their own.
+asset_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
 
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:20.0) Gecko/20100101 Firefox/20.0",
@@ -45,6 +58,43 @@ headers = {
     "Connection": "keep-alive"
 }
 
+sess = requests.Session()
+# Set once here, so requests don't need to merge in headers on every call.
+sess.headers.update(headers)
+
+# Retry transient server errors (502/503/504) at the transport level, and
+# nothing else: connection, SSL and other errors are only retried by
+# `make_request`, so they aren't retried twice.
+retry_policy = Retry(total=None, connect=0, read=0, other=0, redirect=False, status=5,
+        backoff_factor=1, status_forcelist=[502, 503, 504], raise_on_status=False)
+
+# Size the connection pools so that worker threads never wait on a free
+# socket, and keep-alive connections get reused across requests.
+pooled_adapter = HTTPAdapter(pool_connections=MAX_CONCURRENT_REQUESTS,
+        pool_maxsize=4 * MAX_CONCURRENT_REQUESTS, max_retries=retry_policy)
+sess.mount('http://', pooled_adapter)
+sess.mount('https://', pooled_adapter)
+
+# Cached pages are considered fresh for a day. After that they're revalidated
+# with If-None-Match / If-Modified-Since, so unchanged pages come back as a 304
+# and are served from the cache, while changed pages are re-downloaded.
+cache = FileCache('.webcache')
+cached_adapter = CacheControlAdapter(heuristic=ExpiresAfter(days=1), cache=cache, cache_etags=True,
+        pool_connections=2 * MAX_CONCURRENT_REQUESTS, pool_maxsize=2 * MAX_CONCURRENT_REQUESTS,
+        max_retries=retry_policy)
+
+sess.mount('http://migranthealth.eu', cached_adapter)
+
+
+# Article pages and their assets are only written out long enough to be
+# zipped up, so keep them in memory-backed /dev/shm where available. Set
+# MEET_SCRATCH_DIR to use another directory (e.g. where /dev/shm is small).
+SCRATCH_DIR = os.environ.get('MEET_SCRATCH_DIR') or \
+    ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+# Where the MEET login session is kept between chef runs.
+COOKIES_PATH = '.meet_cookies'
+
 MEET_LICENSE = licenses.SpecialPermissionsLicense(
     description="Permission has been granted by MEET to"
     " distribute this content through Kolibri.",
@@ -74,8 +124,9 @@ class MeetChef(SushiChef):
         # create channel
         channel = self.get_channel()
 
-        login_to_meet()
-        fetch_all_languages(channel)
+        if not restore_login_session():
+            login_to_meet()
+        asyncio.run(fetch_all_languages(channel))
 
         return channel
 
@@ -87,19 +138,53 @@ def login_to_meet():
         'rememberusername': '1',
         'anchor': '',
     })
+    # A failed login lands back on the login page; don't save that session.
+    if '/login/' in response.url:
+        print('WARNING: logging in to MEET failed; check the credentials in secrets.py.')
+        return
+
+    # The cookies hold a live session, so make the file readable only by us.
+    fd = os.open(COOKIES_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(sess.cookies, f)
 
 
-def fetch_all_languages(channel):
-    doc = get_parsed_html_from_url('http://migranthealth.eu/etraining/')
-    for link in doc.select('.category.essentialcats a'):
-        url = link['href']
-        language_name = link.text.strip()[len('MEET '):]
+def restore_login_session():
+    """Reuse the login cookies saved by a previous run, if the session they
+    belong to is still valid. Returns whether we're logged in.
+    """
+    if not os.path.exists(COOKIES_PATH):
+        return False
+    with open(COOKIES_PATH, 'rb') as f:
+        sess.cookies.update(pickle.load(f))
+
+    # Moodle redirects to the login page once the session has expired.
+    response = sess.head('http://migranthealth.eu/etraining/my/', allow_redirects=False)
+    if response.status_code == 401 or '/login/' in response.headers.get('Location', ''):
+        sess.cookies.clear()
+        return False
+
+    print('Reusing MEET login session from %s' % COOKIES_PATH)
+    return True
+
+
+async def fetch_all_languages(channel):
+    tree = await run_blocking(get_fast_parsed_html_from_url, 'http://migranthealth.eu/etraining/')
+    language_fetches = []
+    for link in tree.css('.category.essentialcats a'):
+        url = link.attributes['href']
+        language_name = link.text().strip()[len('MEET '):]
         language = languages.getlang_by_name(language_name)
-        language_node = fetch_language(url, language)
+        language_fetches.append(fetch_language(url, language))
+
+    if not language_fetches:
+        print('WARNING: no languages found on the MEET front page.')
+
+    for language_node in await asyncio.gather(*language_fetches):
         channel.add_child(language_node)
 
 
-def fetch_language(url, language):
+async def fetch_language(url, language):
     """E.g. English from http://migranthealth.eu/etraining/course/index.php?categoryid=1"""
     print('Fetching language %s from %s' % (language.name, url))
 
@@ -108,17 +193,21 @@ def fetch_language(url, language):
         title=language.native_name,
         language=language,
     )
-    doc = get_parsed_html_from_url(url)
+    tree = await run_blocking(get_fast_parsed_html_from_url, url)
 
-    for course in doc.select('.coursename'):
-        title = course.text
-        url = course.select_one('a')['href']
-        language_node.add_child(fetch_module(url, title))
+    module_fetches = []
+    for course in tree.css('.coursename'):
+        title = course.text()
+        url = course.css_first('a').attributes['href']
+        module_fetches.append(fetch_module(url, title))
+
+    for module_node in await asyncio.gather(*module_fetches):
+        language_node.add_child(module_node)
 
     return language_node
 
 
-def fetch_module(url, title):
+async def fetch_module(url, title):
     """E.g. Module 1: Planning a CHE service
     from http://migranthealth.eu/etraining/course/view.php?id=3
     """
@@ -129,34 +218,72 @@ def fetch_module(url, title):
         title=title,
         language="en",
     )
-    doc = get_parsed_html_from_url(url)
+    tree = await run_blocking(get_fast_parsed_html_from_url, url)
 
     # If we haven't enrolled into the module yet, enroll!
-    form = doc.select_one('form#mform1')
-    if form and form['action'] == 'http://migranthealth.eu/etraining/enrol/index.php':
+    form = tree.css_first('form#mform1')
+    if is_enrollment_form(form):
         print('  ... not enrolled yet, so enrolling then reloading the page.')
-        post_values = {}
-        for element in doc.select('form#mform1 input'):
-            if element.has_attr('value'):
-                post_values[element['name']] = element['value']
-        sess.post(form['action'], post_values)
-        time.sleep(1)
-        doc = get_parsed_html_from_url(url)
-
-    for section in doc.select('.course-content .topics .section.main'):
-        section_title = section.select_one('.section-title')
+        post_values = {element.attributes['name']: element.attributes['value']
+                for element in form.css('input[name][value]')}
+        # Moodle redirects back to the course page once we're enrolled. The HTTP
+        # cache still holds the pre-enrollment page, so bypass it; requests
+        # carries the header over to the redirected GET.
+        response = await run_blocking(functools.partial(sess.post,
+                form.attributes['action'], post_values, headers=NO_CACHE_HEADERS))
+
+        # The POST response is usually the page we want, but only trust it if
+        # it's this course page (and not e.g. a Moodle error page). Otherwise
+        # reload (with a short pause between attempts) until the enrollment
+        # shows up.
+        tree = None
+        if response.status_code == 200 and response.url == url:
+            tree = parse_fast(response.content)
+        for attempt in range(MAX_ENROLLMENT_RELOADS):
+            if is_enrolled_page(tree):
+                break
+            if attempt > 0:
+                await asyncio.sleep(0.2)
+            tree = await run_blocking(functools.partial(get_fast_parsed_html_from_url,
+                    url, headers=NO_CACHE_HEADERS))
+        if not is_enrolled_page(tree):
+            print('  WARNING: still not enrolled in "%s" after %d reloads; its units will be missing.'
+                  % (title, MAX_ENROLLMENT_RELOADS))
+
+    unit_fetches = []
+    for section in tree.css('.course-content .topics .section.main'):
+        section_title = section.css_first('.section-title')
         if not section_title:
             continue
-        unit_title = section_title.text.strip()
-        unit_url = section_title.select_one('a')['href']
-        unit_description = section.select_one('.summarytext').text.strip()
-        unit = fetch_unit(unit_url, unit_title, unit_description)
+        unit_title = section_title.text().strip()
+        unit_url = section_title.css_first('a').attributes['href']
+        unit_description = section.css_first('.summarytext').text().strip()
+        unit_fetches.append(fetch_unit(unit_url, unit_title, unit_description))
+
+    for unit in await asyncio.gather(*unit_fetches):
         module_node.add_child(unit)
 
     return module_node
 
 
-def fetch_unit(url, title, description):
+MAX_ENROLLMENT_RELOADS = 3
+
+# Sent on requests whose response must not come from the HTTP cache.
+NO_CACHE_HEADERS = {'Cache-Control': 'no-cache'}
+
+
+def is_enrollment_form(form):
+    return form is not None and \
+        form.attributes.get('action') == 'http://migranthealth.eu/etraining/enrol/index.php'
+
+
+def is_enrolled_page(tree):
+    """Whether `tree` is a course page showing the course content."""
+    return tree is not None and tree.css_first('.course-content') is not None and \
+        not is_enrollment_form(tree.css_first('form#mform1'))
+
+
+async def fetch_unit(url, title, description):
     """E.g. Unit 3: Needs and Context Analysis
     from http://migranthealth.eu/etraining/course/view.php?id=3&section=3
     """
@@ -168,72 +295,82 @@ def fetch_unit(url, title, description):
         language="en",
         description=description,
     )
-    doc = get_parsed_html_from_url(url)
-    for unit in doc.select('.course-content .topics .content .activity.modtype_page'):
-        article_title = unit.select_one('.instancename').contents[0].strip()
-        article_url = unit.select_one('a')['href']
-        article = fetch_article(article_url, article_title)
+    tree = await run_blocking(get_fast_parsed_html_from_url, url)
+    article_fetches = []
+    for unit in tree.css('.course-content .topics .content .activity.modtype_page'):
+        article_title = unit.css_first('.instancename').text(deep=False).strip()
+        article_url = unit.css_first('a').attributes['href']
+        article_fetches.append(fetch_article(article_url, article_title))
+
+    for article in await asyncio.gather(*article_fetches):
         unit_node.add_child(article)
 
     return unit_node
 
 
-def fetch_article(url, title):
+async def fetch_article(url, title):
     """E.g. The context Section 2
     from http://migranthealth.eu/etraining/mod/page/view.php?id=75
     """
     print('      Fetching article "%s" from %s' % (title, url))
-    return download_content_node(url, title)
+    # Ricecooker's download_static_assets is synchronous, so keep it off the event loop.
+    return await run_blocking(download_content_node, url, title)
 
 
 ################################################################################
 # General helpers
 
 
+async def run_blocking(fn, *args):
+    """Run a blocking call (network I/O, Ricecooker helpers) on the shared
+    worker pool, so sibling pages are fetched concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+@functools.lru_cache(maxsize=4096)
 def derive_filename(url):
+    """E.g. '3f2a9c1d0b7e.style.css' from http://migranthealth.eu/theme/Style.CSS?rev=12
+
+    The prefix is a hash of the URL, so an asset gets the same name on every
+    page and every run, and is only downloaded once per page.
+    """
     if url.split('/')[-1] == 'all':
         return 'all.css'
-    name = os.path.basename(urlparse(url).path).replace('%', '_')
-    return ("%s.%s" % (uuid.uuid4().hex, name)).lower()
+    path = url.split('#', 1)[0].split('?', 1)[0]
+    name = path.rsplit('/', 1)[-1].replace('%', '_').lower()
+    return "%s.%s" % (hashlib.blake2b(url.encode('utf-8'), digest_size=6).hexdigest(), name)
 
 
 # TODO(davidhu): Extract this out to Ricecooker too
 def download_content_node(url, title):
     doc = get_parsed_html_from_url(url)
 
-    destination = tempfile.mkdtemp()
-    doc = download_static_assets(doc, destination,
-            'http://migranthealth.eu/', request_fn=make_request,
-            url_blacklist=url_blacklist, derive_filename=derive_filename)
-
-    nodes_to_remove = [
-        'header',
-        '#page-top-header',
-        '#block-region-side-pre',
-        '#region-main .row-fluid .span4.heading-rts',
-        '.readmoreLinks',
-        '.courseSectionNext',
-        'img[alt="next"]',
-        '.modified',
-        '.footer-rts',
-        '#page-footer',
-        '.back-to-top',
-        '.skiplinks',
-        '.linkicon',
-        '.generalbox table tr:nth-of-type(2)',
-    ]
-    for selector in nodes_to_remove:
-        for node in doc.select(selector):
-            node.decompose()
+    destination = tempfile.mkdtemp(dir=SCRATCH_DIR)
+    try:
+        base_url = 'http://migranthealth.eu/'
+        doc = download_static_assets(doc, destination,
+                base_url, request_fn=prefetch_static_assets(doc, base_url),
+                url_blacklist=url_blacklist, derive_filename=derive_filename)
+
+        # Strip the unwanted nodes with lxml, in one walk over the tree.
+        tree = lxml.html.document_fromstring(doc.encode('utf-8'),
+                parser=lxml.html.HTMLParser(encoding='utf-8'))
+        for node in nodes_to_remove_xpath(tree):
+            node.drop_tree()
+
+        # Write out the HTML source.
+        with open(os.path.join(destination, "index.html"), "wb") as f:
+            f.write(lxml.html.tostring(tree.getroottree(), encoding='utf-8', method='html'))
 
-    # Write out the HTML source.
-    with open(os.path.join(destination, "index.html"), "w") as f:
-        f.write(str(doc))
+        print("        ... downloaded to %s" % destination)
+        #preview_in_browser(destination)
 
-    print("        ... downloaded to %s" % destination)
-    #preview_in_browser(destination)
+        zip_path = create_predictable_zip(destination)
+    finally:
+        shutil.rmtree(destination)
 
-    zip_path = create_predictable_zip(destination)
     return nodes.HTML5AppNode(
         source_id=url,
         title=truncate_metadata(title),
@@ -243,6 +380,51 @@ def download_content_node(url, title):
     )
 
 
+def prefetch_static_assets(doc, base_url):
+    """Download the assets `doc` links to directly (images, CSS, JS) in
+    parallel, and return a `request_fn` for `download_static_assets` that
+    serves them from memory. Anything else (e.g. fonts referenced from CSS)
+    falls through to `make_request`.
+
+    The selection mirrors what `download_static_assets` will actually request,
+    so that nothing is downloaded only to be thrown away.
+    """
+    asset_urls = set()
+    for selector, attr in prefetched_asset_selectors:
+        for node in doc.select(selector):
+            if node.name == 'link' and not is_stylesheet_link(node):
+                continue
+            if node[attr].startswith('data:'):
+                continue
+            asset_url = urljoin(base_url, node[attr])
+            if is_blacklisted(asset_url):
+                continue
+            asset_urls.add(asset_url)
+
+    responses = dict(zip(asset_urls, asset_executor.map(make_request, asset_urls)))
+
+    def request_fn(url, *args, **kwargs):
+        response = responses.pop(url, None)
+        if response is None:
+            response = make_request(url, *args, **kwargs)
+        return response
+
+    return request_fn
+
+
+def is_stylesheet_link(node):
+    # Ricecooker 0.8.0's CSS filter (css_node_filter) checks `"rel" in node`,
+    # which looks at the tag's children rather than its attributes, so in
+    # practice it only keeps links to *.css files. Match that, rather than the
+    # `rel` attribute. Revisit this when changing the pinned ricecooker version.
+    return node['href'].split('?')[0].strip().endswith('.css')
+
+
+def is_blacklisted(url):
+    # Same check as Ricecooker 0.8.0's _is_blacklisted, which lowercases the URL.
+    return any(item in url.lower() for item in url_blacklist)
+
+
 def truncate_metadata(data_string):
     MAX_CHARS = 190
     if len(data_string) > MAX_CHARS:
@@ -259,20 +441,50 @@ url_blacklist = [
 ]
 
 
-def make_request(url, headers=headers, timeout=60, *args, **kwargs):
+nodes_to_remove = [
+    'header',
+    '#page-top-header',
+    '#block-region-side-pre',
+    '#region-main .row-fluid .span4.heading-rts',
+    '.readmoreLinks',
+    '.courseSectionNext',
+    'img[alt="next"]',
+    '.modified',
+    '.footer-rts',
+    '#page-footer',
+    '.back-to-top',
+    '.skiplinks',
+    '.linkicon',
+    '.generalbox table tr:nth-of-type(2)',
+]
+
+prefetched_asset_selectors = [
+    ('img[src]', 'src'),
+    ('link[href]', 'href'),
+    ('script[src]', 'src'),
+    ('source[src]', 'src'),
+]
+
+# Compiled once up front into a single XPath union, so that all of these are
+# found with one pass over the page.
+nodes_to_remove_xpath = lxml.etree.XPath(' | '.join(
+    HTMLTranslator().css_to_xpath(selector) for selector in nodes_to_remove))
+
+
+def make_request(url, timeout=60, *args, **kwargs):
     retry_count = 0
     max_retries = 5
     while True:
         try:
-            response = sess.get(url, headers=headers, timeout=timeout, *args, **kwargs)
+            response = sess.get(url, timeout=timeout, *args, **kwargs)
             break
         except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
             retry_count += 1
             print("Error with connection ('{msg}'); about to perform retry {count} of {trymax}."
                   .format(msg=str(e), count=retry_count, trymax=max_retries))
-            time.sleep(retry_count * 1)
             if retry_count >= max_retries:
                 return Dummy404ResponseObject(url=url)
+            time.sleep(2 ** (retry_count - 1))
 
     if response.status_code != 200:
         print("NOT FOUND:", url)
@@ -281,8 +493,33 @@ def make_request(url, headers=headers, timeout=60, *args, **kwargs):
 
 
 def get_parsed_html_from_url(url, *args, **kwargs):
+    # Hand the (decompressed) body straight to the parser, rather than
+    # buffering it in `response.content` first.
+    with make_request(url, *args, stream=True, **kwargs) as response:
+        response.raw.decode_content = True
+        encoding = get_charset(response)
+        return BeautifulSoup(response.raw, "lxml", from_encoding=encoding)
+
+
+def get_charset(response, default='utf-8'):
+    """The charset declared in the response's Content-Type header. Passing this
+    to BeautifulSoup saves it from sniffing the encoding; Moodle serves UTF-8.
+    """
+    match = re.search(r'charset=["\']?([\w-]+)', response.headers.get('Content-Type', ''))
+    return match.group(1) if match else default
+
+
+def get_fast_parsed_html_from_url(url, *args, **kwargs):
+    """Like `get_parsed_html_from_url`, but returns a (much faster) selectolax
+    tree. Use this for read-only traversals; use BeautifulSoup when the tree
+    needs to be modified and written back out.
+    """
     html = make_request(url, *args, **kwargs).content
-    return BeautifulSoup(html, "html.parser")
+    return parse_fast(html)
+
+
+def parse_fast(html):
+    return LexborHTMLParser(html)
 
 
 if __name__ == '__main__':